@@ -1,27 +1,50 @@
-from fastapi import FastAPI, HTTPException, Depends
-from typing import List
-from app.models import Collection, Tag, Excerpt
+import re
+import queue
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from typing import List, Optional
+from app.models import Collection, Tag, Excerpt, ParagraphSummary
 from app.func import (
     get_connection,
+    get_attachment as db_get_attachment,
+    read_attachment as db_read_attachment,
     add_collection as db_add_collection,
     get_collections as db_get_collections,
     add_tag as db_add_tag,
     get_tags as db_get_tags,
+    suggest_tags as db_suggest_tags,
     add_paragraph as db_add_paragraph,
     get_paragraphs as db_get_paragraphs,
+    get_paragraph_summaries as db_get_paragraph_summaries,
     update_paragraph as db_update_paragraph,
     delete_paragraph as db_delete_paragraph,
 )
 
 app = FastAPI()
 
+# Idle connections, reused across requests so each one doesn't pay for
+# opening the database and setting it up
+connection_pool = queue.SimpleQueue()
+
+def acquire_connection():
+    try:
+        return connection_pool.get_nowait()
+    except queue.Empty:
+        # Requests may run the dependency and the endpoint on different threads
+        return get_connection(check_same_thread=False)
+
+def release_connection(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    connection_pool.put(conn)
+
 # Dependency to get the database connection
 def get_db():
-    conn = get_connection()
+    conn = acquire_connection()
     try:
         yield conn
     finally:
-        conn.close()
+        release_connection(conn)
 
 @app.post("/collections/", response_model=Collection)
 def create_collection(collection: Collection, db = Depends(get_db)):
@@ -35,23 +58,50 @@ def list_collections(db = Depends(get_db)):
 
 @app.post("/tags/", response_model=Tag)
 def create_tag(tag: Tag, db = Depends(get_db)):
-    db_tag = db_add_tag(db, tag.name, tag.description)
-    return Tag(id=db_tag.id, name=db_tag.name, description=db_tag.description)
+    try:
+        db_tag = db_add_tag(db, tag.name, tag.description, parent_id=tag.parent_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Tag(id=db_tag.id, name=db_tag.name, description=db_tag.description, parent_id=db_tag.parent_id)
 
 @app.get("/tags/", response_model=List[Tag])
 def list_tags(db = Depends(get_db)):
     tags = db_get_tags(db)
-    return [Tag(id=tag.id, name=tag.name, description=tag.description) for tag in tags]
+    return [Tag(id=tag.id, name=tag.name, description=tag.description, parent_id=tag.parent_id) for tag in tags]
+
+@app.get("/tags/suggest", response_model=List[Tag])
+def suggest_tags(prefix: str, limit: int = Query(10, ge=1, le=100), fuzzy: bool = False, db = Depends(get_db)):
+    tags = db_suggest_tags(db, prefix, limit=limit, fuzzy=fuzzy)
+    return [Tag(id=tag.id, name=tag.name, description=tag.description, parent_id=tag.parent_id) for tag in tags]
 
 @app.post("/paragraphs/", response_model=Excerpt)
 def create_paragraph(paragraph: Excerpt, db = Depends(get_db)):
-    db_paragraph = db_add_paragraph(db, paragraph.title, paragraph.content, paragraph.collection_id, paragraph.tags)
-    return Excerpt(id=db_paragraph.id, title=db_paragraph.title, content=db_paragraph.content, collection_id=db_paragraph.collection_id, tags=paragraph.tags)
+    try:
+        paragraph_id = db_add_paragraph(
+            db,
+            collection_id=paragraph.collection_id,
+            title=paragraph.title,
+            content=paragraph.content,
+            tag_ids=paragraph.tags,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Excerpt(id=paragraph_id, title=paragraph.title, content=paragraph.content, collection_id=paragraph.collection_id, tags=paragraph.tags)
 
 @app.get("/paragraphs/", response_model=List[Excerpt])
-def list_paragraphs(db = Depends(get_db)):
-    paragraphs = db_get_paragraphs(db)
-    return [Excerpt(id=para.id, title=para.title, content=para.content, collection_id=para.collection.id, tags=para.tags) for para in paragraphs]
+def list_paragraphs(tag_id: int = None, fields: str = None, db = Depends(get_db)):
+    # Projection onto summary fields, e.g. ?fields=id,title, skips loading content and tags.
+    # Returned as a plain JSON response, since it doesn't match the Excerpt model.
+    if fields:
+        columns = {f.strip() for f in fields.split(',') if f.strip()}
+        invalid = columns - set(ParagraphSummary.model_fields)
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid fields: {', '.join(sorted(invalid))}")
+        summaries = db_get_paragraph_summaries(db, tag_id=tag_id)
+        return JSONResponse([summary.model_dump(include=columns) for summary in summaries])
+
+    paragraphs = db_get_paragraphs(db, tag_id=tag_id)
+    return [Excerpt(id=para.id, title=para.title, content=para.content, collection_id=para.collection.id, tags=[tag.id for tag in para.tags]) for para in paragraphs]
 
 @app.put("/paragraphs/{paragraph_id}", response_model=Excerpt)
 def update_paragraph(paragraph_id: int, paragraph: Excerpt, db = Depends(get_db)):
@@ -66,3 +116,72 @@ def delete_paragraph(paragraph_id: int, db = Depends(get_db)):
     if not success:
         raise HTTPException(status_code=404, detail="Excerpt not found")
     return {"detail": "Excerpt deleted successfully"}
+
+def stream_attachment(attachment, start: int, end: int):
+    # The request's connection is released once the response starts, so the
+    # body is read through a connection of its own
+    conn = acquire_connection()
+    try:
+        yield from db_read_attachment(conn, attachment, start, end)
+    finally:
+        release_connection(conn)
+
+def parse_range(header: str, size: int):
+    """
+    Return the (start, end) of a single byte range such as bytes=0-499, bytes=500- 
+    or bytes=-500. Anything else, multiple ranges included, returns None so the 
+    whole attachment is sent, as a server may ignore ranges it doesn't support.
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header, re.IGNORECASE)
+    if not match or not any(match.groups()):
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        # The last N bytes, where zero of them selects nothing
+        start, end = (max(size - int(last), 0) if int(last) else size), size
+    elif last and int(last) < int(first):
+        return None
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+
+    return start, end
+
+@app.get("/attachments/{attachment_hash}")
+def get_attachment(attachment_hash: str,
+                   range: Optional[str] = Header(None),
+                   if_none_match: Optional[str] = Header(None),
+                   db = Depends(get_db)):
+    attachment = db_get_attachment(db, attachment_hash)
+    if not attachment:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    # Attachments are content-addressed, so the hash is a strong ETag
+    etag = f'"{attachment.hash}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    start, end, status_code = 0, attachment.size, 200
+
+    byte_range = parse_range(range, attachment.size) if range else None
+
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{attachment.size}"
+
+    headers["Content-Length"] = str(end - start)
+
+    return StreamingResponse(
+        stream_attachment(attachment, start, end),
+        status_code=status_code,
+        media_type=attachment.media_type,
+        headers=headers,
+    )
@@ -1,24 +1,120 @@
+import re
 import sqlite3
+import hashlib
+import zlib
+import base64
+import io
+import mimetypes
 from jinja2 import Template
-from typing import List
-from os import environ, path
+from datetime import timedelta
+from typing import BinaryIO, Dict, Iterator, List, TextIO, Tuple
+from os import environ, makedirs, path
 import tempfile
 import subprocess
+import time
+from contextlib import contextmanager
 
-from app.models import Collection, Paragraph, Tag, TextEditor, get_markdown_safe_text, dict_to_struct
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from app.models import Attachment, Collection, Paragraph, ParagraphSummary, Tag, TextEditor, get_markdown_safe_text, get_markdown_hyperlink, dict_to_struct
+
+# Matches [[Title]] links between paragraphs
+PARAGRAPH_LINK_PATTERN = re.compile(r"\[\[([^\[\]]+)\]\]")
+
+# Matches attachment:<sha256> references to attachments in paragraph content
+ATTACHMENT_PATTERN = re.compile(r"attachment:([0-9a-f]{64})")
+
+# Attachments are read and written in chunks of this many bytes. Multiple of 3 so
+# chunks can be base64 encoded independently.
+ATTACHMENT_CHUNK_SIZE = 3 * 2**16
+
+# Paragraph content longer than this many bytes is stored compressed. 0 disables compression.
+CONTENT_COMPRESSION_THRESHOLD = int(environ.get("CONTENT_COMPRESSION_THRESHOLD", 0))
+
+# Seconds compact_database waits between batches, so concurrent writers are not starved
+COMPACTION_BATCH_PAUSE = 0.05
+
+# "zlib" or "zstd". zstd requires the optional zstandard package.
+CONTENT_COMPRESSION = environ.get("CONTENT_COMPRESSION", "zlib")
 
 # region DB functions
 
-def get_connection():
-    conn = sqlite3.connect("paragraphs.db")
+def get_connection(check_same_thread: bool = True):
+    conn = sqlite3.connect("paragraphs.db", check_same_thread= check_same_thread)
 
     conn.row_factory = sqlite3.Row
 
+    # Must come before anything writes the header of a new database file, so
+    # compact_database can return free pages without a full VACUUM
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # Write-ahead logging lets readers keep a snapshot while writers commit.
+    # The mode is stored in the database file, so this only changes it once.
+    conn.execute("PRAGMA journal_mode = WAL")
+
     return conn
 
+
+@contextmanager
+def read_snapshot(connection: sqlite3.Connection):
+    """
+    Run the reads inside the block in a single read transaction, so they all see 
+    the database as of the first one. In WAL mode this does not block writers.
+    """
+    if connection.in_transaction:
+        # Already consistent with the caller's own transaction
+        yield connection
+        return
+
+    connection.execute("BEGIN")
+
+    try:
+        yield connection
+    finally:
+        connection.rollback()
+
+
+def get_memory_snapshot(connection: sqlite3.Connection) -> sqlite3.Connection:
+    """Copy the database into an in-memory one with the backup API, for long offline reads."""
+    snapshot = sqlite3.connect(":memory:")
+
+    snapshot.row_factory = sqlite3.Row
+
+    connection.backup(snapshot)
+
+    return snapshot
+
 def initialize_database(connection: sqlite3.Connection):
     cursor = connection.cursor()
 
+    has_links_table = cursor.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'paragraph_links'
+    """).fetchone()
+
+    has_trigrams_table = cursor.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tag_trigrams'
+    """).fetchone()
+
+    # Columns added to paragraphs after it was first released
+    paragraph_columns = {row['name'] for row in cursor.execute("PRAGMA table_info(paragraphs)")}
+
+    if paragraph_columns and 'content_hash' not in paragraph_columns:
+        cursor.execute("ALTER TABLE paragraphs ADD COLUMN content_encoding TEXT")
+        cursor.execute("ALTER TABLE paragraphs ADD COLUMN content_hash TEXT")
+
+    tag_columns = {row['name'] for row in cursor.execute("PRAGMA table_info(tags)")}
+
+    if tag_columns and 'usage_count' not in tag_columns:
+        cursor.execute("ALTER TABLE tags ADD COLUMN usage_count INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("""
+            UPDATE tags SET usage_count = (
+                SELECT COUNT(*) FROM paragraph_tags pt WHERE pt.tag_id = tags.id
+            )
+        """)
+
     # Create tables
     cursor.executescript("""
     -- Metadata is embedded into each table, so a separate metadata table isn't needed.
@@ -38,6 +134,9 @@ def initialize_database(connection: sqlite3.Connection):
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         deleted_at DATETIME,
+        -- NULL for plain text, otherwise the codec content was compressed with
+        content_encoding TEXT,
+        content_hash TEXT,
         FOREIGN KEY (collection_id) REFERENCES collections (id)
     );
 
@@ -47,7 +146,9 @@ def initialize_database(connection: sqlite3.Connection):
         description TEXT,
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        deleted_at DATETIME
+        deleted_at DATETIME,
+        -- Number of paragraph_tags rows, kept up to date by the triggers below
+        usage_count INTEGER NOT NULL DEFAULT 0
     );
 
     CREATE TABLE IF NOT EXISTS paragraph_tags (
@@ -57,28 +158,402 @@ def initialize_database(connection: sqlite3.Connection):
         FOREIGN KEY (paragraph_id) REFERENCES paragraphs (id),
         FOREIGN KEY (tag_id) REFERENCES tags (id)
     );
+
+    CREATE INDEX IF NOT EXISTS idx_paragraph_tags_tag_id
+        ON paragraph_tags (tag_id, paragraph_id);
+
+    CREATE TRIGGER IF NOT EXISTS paragraph_tags_count_insert
+    AFTER INSERT ON paragraph_tags BEGIN
+        UPDATE tags SET usage_count = usage_count + 1 WHERE id = NEW.tag_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS paragraph_tags_count_delete
+    AFTER DELETE ON paragraph_tags BEGIN
+        UPDATE tags SET usage_count = usage_count - 1 WHERE id = OLD.tag_id;
+    END;
+
+    -- Closure table for nested tags. Every tag has a row pointing to itself
+    -- (depth 0) plus one row per ancestor, so descendant lookups are a
+    -- single indexed range scan instead of a recursive walk.
+    CREATE TABLE IF NOT EXISTS tag_parents (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id),
+        FOREIGN KEY (ancestor_id) REFERENCES tags (id),
+        FOREIGN KEY (descendant_id) REFERENCES tags (id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_tag_parents_descendant
+        ON tag_parents (descendant_id, depth);
+
+    -- Backfill self references for tags created before nesting existed
+    INSERT OR IGNORE INTO tag_parents (ancestor_id, descendant_id, depth)
+    SELECT id, id, 0 FROM tags;
+
+    CREATE INDEX IF NOT EXISTS idx_paragraphs_collection_title
+        ON paragraphs (collection_id, title);
+
+    -- Covers summary listings and existence checks of live paragraphs
+    -- without reading their content
+    CREATE INDEX IF NOT EXISTS idx_paragraphs_summary
+        ON paragraphs (id, collection_id, title, deleted_at) WHERE deleted_at IS NULL;
+
+    -- [[Title]] links parsed from paragraph content on write. Targets are
+    -- stored by title and resolved within the source paragraph's collection.
+    CREATE TABLE IF NOT EXISTS paragraph_links (
+        source_id INTEGER NOT NULL,
+        target_title TEXT NOT NULL,
+        PRIMARY KEY (source_id, target_title),
+        FOREIGN KEY (source_id) REFERENCES paragraphs (id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_paragraph_links_target
+        ON paragraph_links (target_title, source_id);
+
+    CREATE INDEX IF NOT EXISTS idx_paragraphs_content_hash
+        ON paragraphs (collection_id, content_hash) WHERE deleted_at IS NULL;
+
+    -- Media referenced from paragraph content as attachment:<hash>, stored
+    -- once per distinct content
+    CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hash TEXT NOT NULL UNIQUE,
+        media_type TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Covers prefix suggestions over live tags, ranking included
+    CREATE INDEX IF NOT EXISTS idx_tags_live_name
+        ON tags (name, usage_count, deleted_at) WHERE deleted_at IS NULL;
+
+    -- Trigrams of tag names for fuzzy tag suggestions
+    CREATE TABLE IF NOT EXISTS tag_trigrams (
+        trigram TEXT NOT NULL,
+        tag_id INTEGER NOT NULL,
+        PRIMARY KEY (trigram, tag_id),
+        FOREIGN KEY (tag_id) REFERENCES tags (id)
+    ) WITHOUT ROWID;
     """)
+
+    # Index trigrams of tags created before fuzzy suggestions existed
+    if not has_trigrams_table:
+        for row in cursor.execute("SELECT id, name FROM tags").fetchall():
+            _set_tag_trigrams(cursor, row['id'], row['name'])
+
+    # Parse links of paragraphs written before links existed
+    if not has_links_table:
+        for row in cursor.execute("SELECT id, content, content_encoding FROM paragraphs").fetchall():
+            _set_paragraph_links(cursor, row['id'], decode_content(row['content'], row['content_encoding']))
+
+    # Hash paragraphs written before duplicate detection existed
+    for row in cursor.execute("""
+        SELECT id, content, content_encoding FROM paragraphs WHERE content_hash IS NULL
+    """).fetchall():
+        cursor.execute("""
+            UPDATE paragraphs SET content_hash = ? WHERE id = ?
+        """, (get_content_hash(decode_content(row['content'], row['content_encoding'])), row['id']))
+
     connection.commit()
 
+def _delete_in_batches(connection: sqlite3.Connection, sql: str, values: tuple = (), batch_size: int = 1000) -> int:
+    """
+    Run a DELETE whose statement ends with a "LIMIT ?" subquery until it deletes 
+    nothing, committing after each batch so writers are never held up for long.
+    """
+    cursor = connection.cursor()
+
+    deleted = 0
+
+    while True:
+        cursor.execute(sql, (*values, batch_size))
+        connection.commit()
+
+        if cursor.rowcount <= 0:
+            return deleted
+
+        deleted += cursor.rowcount
+
+        # Give writers waiting on the lock a chance to get it
+        time.sleep(COMPACTION_BATCH_PAUSE)
+
+
+def compact_database(connection: sqlite3.Connection, 
+                     older_than: timedelta, 
+                     batch_size: int = 1000, 
+                     vacuum: bool = False
+                     ) -> Dict[str, int]:
+    """
+    Permanently delete paragraphs soft-deleted more than older_than ago, the tag 
+    and link rows left without a paragraph, and leaf tags that are no longer used 
+    because they were soft-deleted or their last paragraph was purged, then give 
+    the freed pages back to the file system. 
+    Deletes run in small batches, so it is safe to run while the API is serving.
+    Databases created without incremental auto_vacuum only reuse their freed 
+    pages, unless vacuum is set to convert them with a full VACUUM, which locks 
+    out every other connection while it rewrites the file.
+    Returns the number of rows removed per table and the bytes the file shrank by.
+    """
+    cursor = connection.cursor()
+
+    cutoff = f"-{int(older_than.total_seconds())} seconds"
+
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    size_before = cursor.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+    removed = {}
+
+    # Tags of the expired paragraphs may lose their last use below
+    candidate_tag_ids = {row['tag_id'] for row in cursor.execute("""
+        SELECT DISTINCT pt.tag_id FROM paragraph_tags pt
+        JOIN paragraphs p ON p.id = pt.paragraph_id
+        WHERE p.deleted_at < datetime('now', ?)
+    """, (cutoff,))}
+
+    # Links first, so no paragraph_tags or paragraph_links rows are left
+    # pointing to a purged paragraph if compaction is interrupted
+    removed['paragraph_tags'] = _delete_in_batches(connection, """
+        DELETE FROM paragraph_tags WHERE rowid IN (
+            SELECT pt.rowid FROM paragraph_tags pt
+            JOIN paragraphs p ON p.id = pt.paragraph_id
+            WHERE p.deleted_at < datetime('now', ?)
+            LIMIT ?
+        )
+    """, (cutoff,), batch_size)
+
+    removed['paragraph_links'] = _delete_in_batches(connection, """
+        DELETE FROM paragraph_links WHERE rowid IN (
+            SELECT pl.rowid FROM paragraph_links pl
+            JOIN paragraphs p ON p.id = pl.source_id
+            WHERE p.deleted_at < datetime('now', ?)
+            LIMIT ?
+        )
+    """, (cutoff,), batch_size)
+
+    removed['paragraphs'] = _delete_in_batches(connection, """
+        DELETE FROM paragraphs WHERE id IN (
+            SELECT id FROM paragraphs
+            WHERE deleted_at < datetime('now', ?)
+            LIMIT ?
+        )
+    """, (cutoff,), batch_size)
+
+    # Orphans left behind by earlier hard deletes
+    removed['paragraph_tags'] += _delete_in_batches(connection, """
+        DELETE FROM paragraph_tags WHERE rowid IN (
+            SELECT pt.rowid FROM paragraph_tags pt
+            WHERE NOT EXISTS (SELECT 1 FROM paragraphs p WHERE p.id = pt.paragraph_id)
+            OR NOT EXISTS (SELECT 1 FROM tags t WHERE t.id = pt.tag_id)
+            LIMIT ?
+        )
+    """, (), batch_size)
+
+    removed['paragraph_links'] += _delete_in_batches(connection, """
+        DELETE FROM paragraph_links WHERE rowid IN (
+            SELECT pl.rowid FROM paragraph_links pl
+            WHERE NOT EXISTS (SELECT 1 FROM paragraphs p WHERE p.id = pl.source_id)
+            LIMIT ?
+        )
+    """, (), batch_size)
+
+    # Tags that were soft-deleted before the cutoff, or that lost their last
+    # paragraph above, as long as they are unused and have no sub-tags. They
+    # are all checked before any is deleted, so parents left without children
+    # are not purged in turn and the hierarchy stays intact.
+    candidate_tag_ids |= {row['id'] for row in cursor.execute("""
+        SELECT id FROM tags WHERE deleted_at < datetime('now', ?)
+    """, (cutoff,))}
+
+    candidate_tag_ids = list(candidate_tag_ids)
+
+    unused = (
+        'NOT EXISTS (SELECT 1 FROM paragraph_tags pt WHERE pt.tag_id = t.id) '
+        'AND NOT EXISTS ('
+        'SELECT 1 FROM tag_parents tp WHERE tp.ancestor_id = t.id AND tp.depth > 0)'
+    )
+
+    tag_ids = []
+
+    for i in range(0, len(candidate_tag_ids), batch_size):
+        batch = candidate_tag_ids[i:i + batch_size]
+
+        tag_ids.extend(row['id'] for row in cursor.execute(f"""
+            SELECT t.id FROM tags t
+            WHERE t.id IN ({', '.join('?' for _ in batch)}) AND {unused}
+        """, batch))
+
+    removed['tags'] = 0
+
+    # The checks are repeated in the DELETE itself, since other connections may
+    # have used or nested a tag since. Closure and trigram rows are only removed
+    # for the tags that statement actually deleted, in the same transaction.
+    for i in range(0, len(tag_ids), batch_size):
+        batch = tag_ids[i:i + batch_size]
+
+        cursor.execute("BEGIN IMMEDIATE")
+
+        try:
+            deleted_ids = [row['id'] for row in cursor.execute(f"""
+                DELETE FROM tags AS t
+                WHERE t.id IN ({', '.join('?' for _ in batch)}) AND {unused}
+                RETURNING id
+            """, batch).fetchall()]
+
+            if deleted_ids:
+                placeholders = ', '.join('?' for _ in deleted_ids)
+
+                cursor.execute(f"DELETE FROM tag_parents WHERE descendant_id IN ({placeholders})", deleted_ids)
+                cursor.execute(f"DELETE FROM tag_trigrams WHERE tag_id IN ({placeholders})", deleted_ids)
+
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+        removed['tags'] += len(deleted_ids)
+
+        time.sleep(COMPACTION_BATCH_PAUSE)
+
+
+    auto_vacuum = cursor.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+    if auto_vacuum != 2:
+        if vacuum:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+    else:
+        # Free pages a batch at a time, to keep each write lock short
+        free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+        while free_pages:
+            cursor.execute(f"PRAGMA incremental_vacuum({batch_size})").fetchall()
+            connection.commit()
+
+            time.sleep(COMPACTION_BATCH_PAUSE)
+
+            remaining = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+            if remaining >= free_pages:
+                break
+
+            free_pages = remaining
+
+    cursor.execute("ANALYZE")
+    cursor.execute("PRAGMA optimize")
+    connection.commit()
+
+    size_after = cursor.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+    # ANALYZE can grow the file when it creates its statistics tables
+    removed['bytes_reclaimed'] = max(size_before - size_after, 0)
+
+    return removed
+
 # endregion
 
 # region Paragraph
 
+def get_content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+def encode_content(content: str) -> Tuple[str | bytes, str | None]:
+    """
+    Return the value to store for a paragraph's content and its encoding. Content 
+    above CONTENT_COMPRESSION_THRESHOLD bytes is compressed, the rest is kept as text.
+    """
+    data = content.encode('utf8')
+
+    if not CONTENT_COMPRESSION_THRESHOLD or len(data) <= CONTENT_COMPRESSION_THRESHOLD:
+        return content, None
+
+    if CONTENT_COMPRESSION == "zstd" and zstandard:
+        compressed, encoding = zstandard.ZstdCompressor().compress(data), "zstd"
+    else:
+        compressed, encoding = zlib.compress(data), "zlib"
+
+    # Not worth it for incompressible content
+    if len(compressed) >= len(data):
+        return content, None
+
+    return compressed, encoding
+
+
+def decode_content(content: str | bytes, encoding: str | None) -> str:
+    if not encoding:
+        return content
+
+    if encoding == "zlib":
+        return zlib.decompress(content).decode('utf8')
+
+    if encoding == "zstd":
+        if not zstandard:
+            raise RuntimeError("The zstandard package is required to read zstd compressed content")
+
+        return zstandard.ZstdDecompressor().decompress(content).decode('utf8')
+
+    raise ValueError(f"Unknown content encoding '{encoding}'")
+
+
+def find_duplicate_paragraph(connection: sqlite3.Connection, collection_id: int, content: str) -> int | None:
+    """Return the id of a paragraph of the collection with exactly the same content, if any."""
+    cursor = connection.cursor()
+
+    row = cursor.execute("""
+        SELECT id FROM paragraphs
+        WHERE collection_id = ? AND content_hash = ? AND deleted_at IS NULL
+        LIMIT 1
+    """, (collection_id, get_content_hash(content))).fetchone()
+
+    return row['id'] if row else None
+
+
+def parse_paragraph_links(content: str) -> List[str]:
+    """Return the distinct titles referenced by [[Title]] links, in order of appearance."""
+    titles = (m.strip() for m in PARAGRAPH_LINK_PATTERN.findall(content))
+
+    return list(dict.fromkeys(t for t in titles if t))
+
+
+def _set_paragraph_links(cursor: sqlite3.Cursor, paragraph_id: int, content: str):
+    cursor.execute("""
+        DELETE FROM paragraph_links WHERE source_id = ?
+    """, (paragraph_id,))
+
+    cursor.executemany("""
+        INSERT INTO paragraph_links (source_id, target_title)
+        VALUES (?, ?)
+    """, ((paragraph_id, title) for title in parse_paragraph_links(content)))
+
+
 def add_paragraph(connection: sqlite3.Connection, 
                   collection_id: int, 
                   title: str, 
                   content: str, 
-                  tag_ids: List[int]
+                  tag_ids: List[int],
+                  allow_duplicate: bool = False
                   ):
     cursor = connection.cursor()
 
+    if not allow_duplicate:
+        duplicate_id = find_duplicate_paragraph(connection, collection_id, content)
+
+        if duplicate_id:
+            raise ValueError(f"Paragraph {duplicate_id} already has the same content")
+
+    stored_content, content_encoding = encode_content(content)
+
     # Insert the paragraph
     cursor.execute("""
-        INSERT INTO paragraphs (collection_id, title, content)
-        VALUES (?, ?, ?)
-    """, (collection_id, title, content))
+        INSERT INTO paragraphs (collection_id, title, content, content_encoding, content_hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, (collection_id, title, stored_content, content_encoding, get_content_hash(content)))
     paragraph_id = cursor.lastrowid
 
+    _set_paragraph_links(cursor, paragraph_id, content)
+
     # Add tags to paragraph
     for tag_id in set(tag_ids):
         cursor.execute("""
@@ -109,7 +584,8 @@ def update_paragraph(connection: sqlite3.Connection,
         values['title'] = title
 
     if content:
-        values['content'] = content
+        values['content'], values['content_encoding'] = encode_content(content)
+        values['content_hash'] = get_content_hash(content)
 
     if not values:
         raise ValueError("No values to update")
@@ -122,6 +598,9 @@ def update_paragraph(connection: sqlite3.Connection,
 
     cursor.execute(sql, values)
 
+    if content:
+        _set_paragraph_links(cursor, paragraph_id, content)
+
     # Update tags
     # Remove all tags
     cursor.execute("""
@@ -153,6 +632,7 @@ def delete_paragraph(connection: sqlite3.Connection, paragraph_id: int):
 def get_paragraphs( connection: sqlite3.Connection,
                     paragraph_id: int = None,
                     collection_id: int = None,
+                    tag_id: int = None,
                    ) -> List[Paragraph]:
     cursor = connection.cursor()
 
@@ -172,6 +652,18 @@ def get_paragraphs( connection: sqlite3.Connection,
         sql += ' AND collection_id = ?'
         values.append(collection_id)
 
+    if tag_id:
+        # Includes paragraphs tagged with any descendant of the tag
+        sql += (
+            ' AND id IN ('
+            'SELECT pt.paragraph_id FROM tag_parents tp '
+            'JOIN paragraph_tags pt ON pt.tag_id = tp.descendant_id '
+            'WHERE tp.ancestor_id = ?)'
+        )
+        values.append(tag_id)
+
+    sql += ' ORDER BY id'
+
     rows = cursor.execute(sql, values).fetchall()
 
     paragraphs = []
@@ -193,7 +685,7 @@ def get_paragraphs( connection: sqlite3.Connection,
         paragraph = Paragraph(
             id= row['id'],
             title= row['title'],
-            content= row['content'],
+            content= decode_content(row['content'], row['content_encoding']),
             created_at= row['created_at'],
             updated_at= row['updated_at'],
             deleted_at= row['deleted_at'],
@@ -205,11 +697,107 @@ def get_paragraphs( connection: sqlite3.Connection,
 
     return paragraphs
 
+def get_paragraph_summaries(connection: sqlite3.Connection,
+                            collection_id: int = None,
+                            tag_id: int = None,
+                            ) -> List[ParagraphSummary]:
+    """Like get_paragraphs, but only fetches ids, titles, collection ids and tag counts."""
+    cursor = connection.cursor()
+
+    sql = (
+        'SELECT p.id, p.title, p.collection_id, '
+        '(SELECT COUNT(*) FROM paragraph_tags pt WHERE pt.paragraph_id = p.id) AS tag_count '
+        'FROM paragraphs p '
+        'WHERE p.deleted_at IS NULL'
+    )
+
+    values = []
+
+    if collection_id:
+        sql += ' AND p.collection_id = ?'
+        values.append(collection_id)
+
+    if tag_id:
+        sql += (
+            ' AND p.id IN ('
+            'SELECT pt.paragraph_id FROM tag_parents tp '
+            'JOIN paragraph_tags pt ON pt.tag_id = tp.descendant_id '
+            'WHERE tp.ancestor_id = ?)'
+        )
+        values.append(tag_id)
+
+    sql += ' ORDER BY p.id'
+
+    rows = cursor.execute(sql, values).fetchall()
+
+    return [dict_to_struct(dict(row), ParagraphSummary) for row in rows]
+
+
+def paragraph_exists(connection: sqlite3.Connection, paragraph_id: int) -> bool:
+    cursor = connection.cursor()
+
+    row = cursor.execute("""
+        SELECT 1 FROM paragraphs
+        WHERE id = ? AND deleted_at IS NULL
+    """, (paragraph_id,)).fetchone()
+
+    return row is not None
+
+
+def get_paragraph_backlinks(connection: sqlite3.Connection, collection_id: int) -> Dict[str, List[int]]:
+    """Map each linked title to the ids of the paragraphs linking to it, within a collection."""
+    cursor = connection.cursor()
+
+    rows = cursor.execute("""
+        SELECT pl.target_title, pl.source_id FROM paragraph_links pl
+        JOIN paragraphs src ON src.id = pl.source_id
+        WHERE src.collection_id = ? AND src.deleted_at IS NULL
+        ORDER BY pl.target_title, pl.source_id
+    """, (collection_id,)).fetchall()
+
+    backlinks = {}
+
+    for row in rows:
+        backlinks.setdefault(row['target_title'], []).append(row['source_id'])
+
+    return backlinks
+
+
+def get_broken_links(connection: sqlite3.Connection, collection_id: int = None) -> List[sqlite3.Row]:
+    """Return the links whose target title matches no paragraph in the source's collection."""
+    cursor = connection.cursor()
+
+    sql = (
+        'SELECT src.id AS paragraph_id, src.title, src.collection_id, pl.target_title '
+        'FROM paragraph_links pl '
+        'JOIN paragraphs src ON src.id = pl.source_id '
+        'WHERE src.deleted_at IS NULL '
+        'AND NOT EXISTS ('
+        'SELECT 1 FROM paragraphs dst '
+        'WHERE dst.collection_id = src.collection_id '
+        'AND dst.title = pl.target_title AND dst.deleted_at IS NULL)'
+    )
+
+    values = []
+
+    if collection_id:
+        sql += ' AND src.collection_id = ?'
+        values.append(collection_id)
+
+    sql += ' ORDER BY src.id, pl.target_title'
+
+    return cursor.execute(sql, values).fetchall()
+
 # endregion
 
 # region Tags
 
-def add_tag(connection: sqlite3.Connection, description: str, name: str = None, paragraph_id: int = None):
+def add_tag(connection: sqlite3.Connection, 
+            description: str, 
+            name: str = None, 
+            paragraph_id: int = None, 
+            parent_id: int = None
+            ):
     cursor = connection.cursor()
     
     if not name:
@@ -226,25 +814,341 @@ def add_tag(connection: sqlite3.Connection, description: str, name: str = None,
         VALUES (?, ?)
     """, (name, description))
 
+    created = cursor.rowcount == 1
+
+    tag_id = cursor.execute("""
+        SELECT id FROM tags WHERE name = ?
+    """, (name,)).fetchone()['id']
+
+    # Every tag is its own ancestor in the closure table
+    cursor.execute("""
+        INSERT OR IGNORE INTO tag_parents (ancestor_id, descendant_id, depth)
+        VALUES (?, ?, 0)
+    """, (tag_id, tag_id))
+
+    _set_tag_trigrams(cursor, tag_id, name)
+
+    if parent_id and created:
+        try:
+            _move_tag(cursor, tag_id, parent_id)
+        except ValueError:
+            connection.rollback()
+            raise
+
+    # An existing tag is never moved as a side effect of adding it again
+    elif parent_id and not cursor.execute("""
+        SELECT 1 FROM tag_parents WHERE ancestor_id = ? AND descendant_id = ? AND depth = 1
+    """, (parent_id, tag_id)).fetchone():
+        connection.rollback()
+        raise ValueError(f"Tag '{name}' already exists, use set-tag-parent to move it")
+
     if paragraph_id:
         cursor.execute("""
             INSERT INTO paragraph_tags (paragraph_id, tag_id)
-            VALUES (?, (SELECT id FROM tags WHERE name = ?))
-        """, (paragraph_id, name))
+            VALUES (?, ?)
+        """, (paragraph_id, tag_id))
 
     connection.commit()
 
-    return Tag(id=cursor.lastrowid, name=name, description=description)
+    row = cursor.execute("""
+        SELECT t.*, tp.ancestor_id AS parent_id FROM tags t
+        LEFT JOIN tag_parents tp ON tp.descendant_id = t.id AND tp.depth = 1
+        WHERE t.id = ?
+    """, (tag_id,)).fetchone()
+
+    return dict_to_struct(dict(row), Tag)
+
+
+def get_trigrams(text: str) -> List[str]:
+    """Return the distinct trigrams of a text. Texts shorter than three characters are their own trigram."""
+    text = text.lower()
+
+    if len(text) < 3:
+        return [text] if text else []
+
+    return list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+
+
+def _set_tag_trigrams(cursor: sqlite3.Cursor, tag_id: int, name: str):
+    cursor.executemany("""
+        INSERT OR IGNORE INTO tag_trigrams (trigram, tag_id)
+        VALUES (?, ?)
+    """, ((trigram, tag_id) for trigram in get_trigrams(name)))
+
+
+def _move_tag(cursor: sqlite3.Cursor, tag_id: int, parent_id: int = None):
+    for id in (tag_id, parent_id):
+        if id is None:
+            continue
+
+        if not cursor.execute("SELECT 1 FROM tags WHERE id = ?", (id,)).fetchone():
+            raise ValueError(f"Tag {id} not found")
+
+    if parent_id is not None:
+        # The new parent cannot be the tag itself or one of its descendants
+        cycle = cursor.execute("""
+            SELECT 1 FROM tag_parents
+            WHERE ancestor_id = ? AND descendant_id = ?
+        """, (tag_id, parent_id)).fetchone()
+
+        if cycle:
+            raise ValueError("A tag cannot be nested under itself or its descendants")
+
+    # Detach the subtree from its current ancestors
+    cursor.execute("""
+        DELETE FROM tag_parents
+        WHERE descendant_id IN (
+            SELECT descendant_id FROM tag_parents WHERE ancestor_id = ?
+        )
+        AND ancestor_id NOT IN (
+            SELECT descendant_id FROM tag_parents WHERE ancestor_id = ?
+        )
+    """, (tag_id, tag_id))
 
+    if parent_id is None:
+        return
 
-def get_tags(connection: sqlite3.Connection) -> List[Tag]:
+    # Attach the subtree under every ancestor of the new parent
+    cursor.execute("""
+        INSERT INTO tag_parents (ancestor_id, descendant_id, depth)
+        SELECT super.ancestor_id, sub.descendant_id, super.depth + sub.depth + 1
+        FROM tag_parents super
+        CROSS JOIN tag_parents sub
+        WHERE super.descendant_id = ? AND sub.ancestor_id = ?
+    """, (parent_id, tag_id))
+
+
+def set_tag_parent(connection: sqlite3.Connection, tag_id: int, parent_id: int = None):
+    """Move a tag, along with its descendants, under another tag. A parent of None makes it a root tag."""
+    cursor = connection.cursor()
+
+    _move_tag(cursor, tag_id, parent_id)
+
+    connection.commit()
+
+
+def get_tags(connection: sqlite3.Connection, names: List[str] = None) -> List[Tag]:
     cursor = connection.cursor()
 
-    rows = cursor.execute("SELECT * FROM tags").fetchall()
+    sql = (
+        'SELECT t.*, tp.ancestor_id AS parent_id FROM tags t '
+        'LEFT JOIN tag_parents tp ON tp.descendant_id = t.id AND tp.depth = 1'
+    )
+
+    values = []
+
+    if names is not None:
+        sql += ' WHERE t.name IN (%s)' % ', '.join('?' for _ in names)
+        values.extend(names)
+
+    rows = cursor.execute(sql, values).fetchall()
 
     return [dict_to_struct(dict(row), Tag) for row in rows]
 
 
+def suggest_tags(connection: sqlite3.Connection, 
+                 prefix: str, 
+                 limit: int = 10, 
+                 fuzzy: bool = False
+                 ) -> List[Tag]:
+    """
+    Suggest tags whose name starts with the prefix, most used first. The prefix 
+    is matched as a range on an index of live tag names, so only matching 
+    tags are read. In fuzzy mode tags are ranked by the trigrams they share with 
+    the prefix instead, which tolerates typos and matches in the middle of names. 
+    Fuzzy prefixes shorter than a trigram are matched as plain prefixes.
+    """
+    cursor = connection.cursor()
+
+    prefix = get_markdown_safe_text(prefix)
+
+    if not prefix or limit < 1:
+        return []
+
+    # Too short to share a trigram with anything longer, so fall back to the prefix
+    if fuzzy and len(prefix) >= 3:
+        trigrams = get_trigrams(prefix)
+
+        rows = cursor.execute(f"""
+            SELECT t.*, tp.ancestor_id AS parent_id FROM (
+                SELECT tag_id, COUNT(*) AS hits FROM tag_trigrams
+                WHERE trigram IN ({', '.join('?' for _ in trigrams)})
+                GROUP BY tag_id
+            ) m
+            JOIN tags t ON t.id = m.tag_id
+            LEFT JOIN tag_parents tp ON tp.descendant_id = t.id AND tp.depth = 1
+            WHERE t.deleted_at IS NULL
+            ORDER BY m.hits DESC, t.usage_count DESC, t.name
+            LIMIT ?
+        """, (*trigrams, limit)).fetchall()
+
+    else:
+        # Smallest string greater than every string starting with the prefix
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        # Only the candidates that make the cut are joined with their parents
+        rows = cursor.execute(f"""
+            SELECT t.*, tp.ancestor_id AS parent_id FROM (
+                SELECT t.id, t.usage_count FROM tags t
+                WHERE t.name >= ? AND t.name < ? AND t.deleted_at IS NULL
+                ORDER BY t.usage_count DESC, t.name
+                LIMIT ?
+            ) m
+            JOIN tags t ON t.id = m.id
+            LEFT JOIN tag_parents tp ON tp.descendant_id = t.id AND tp.depth = 1
+            ORDER BY m.usage_count DESC, t.name
+        """, (prefix, upper_bound, limit)).fetchall()
+
+    return [dict_to_struct(dict(row), Tag) for row in rows]
+
+
+def get_tag_tree(connection: sqlite3.Connection, collection_id: int = None) -> List[Tuple[Tag, int]]:
+    """
+    Return the tags as (tag, depth) pairs in depth-first order, so they can be 
+    rendered as a nested index. When a collection is given, only tags with 
+    paragraphs of that collection somewhere in their subtree are returned.
+    """
+    cursor = connection.cursor()
+
+    sql = (
+        'SELECT t.*, tp.ancestor_id AS parent_id FROM tags t '
+        'LEFT JOIN tag_parents tp ON tp.descendant_id = t.id AND tp.depth = 1'
+    )
+
+    values = []
+
+    if collection_id:
+        sql += (
+            ' WHERE t.id IN ('
+            'SELECT tp.ancestor_id FROM paragraphs p '
+            'JOIN paragraph_tags pt ON pt.paragraph_id = p.id '
+            'JOIN tag_parents tp ON tp.descendant_id = pt.tag_id '
+            'WHERE p.collection_id = ? AND p.deleted_at IS NULL)'
+        )
+        values.append(collection_id)
+
+    sql += ' ORDER BY t.description, t.name'
+
+    tags = [dict_to_struct(dict(row), Tag) for row in cursor.execute(sql, values)]
+
+    children = {}
+
+    for tag in tags:
+        children.setdefault(tag.parent_id, []).append(tag)
+
+    tree = []
+
+    # Iterative walk, deep trees would exceed the recursion limit
+    stack = [(tag, 0) for tag in reversed(children.get(None, []))]
+
+    while stack:
+        tag, depth = stack.pop()
+
+        tree.append((tag, depth))
+
+        stack.extend((child, depth + 1) for child in reversed(children.get(tag.id, [])))
+
+    return tree
+
+
+# endregion
+
+# region Attachments
+
+def add_attachment(connection: sqlite3.Connection, 
+                   file: BinaryIO, 
+                   media_type: str = "application/octet-stream"
+                   ) -> Attachment:
+    """
+    Store the contents of a binary file as an attachment, unless an attachment 
+    with the same contents exists already. The file is read in chunks and written 
+    with incremental blob I/O, so it is never held in memory as a whole.
+    """
+    # The file is read twice, once to hash it and once to store it, so
+    # streams that cannot seek are spooled to a temporary file first
+    if not file.seekable():
+        with tempfile.SpooledTemporaryFile(max_size= ATTACHMENT_CHUNK_SIZE) as spooled:
+            while chunk := file.read(ATTACHMENT_CHUNK_SIZE):
+                spooled.write(chunk)
+
+            spooled.seek(0)
+
+            return add_attachment(connection, spooled, media_type)
+
+    cursor = connection.cursor()
+
+    start = file.tell()
+
+    digest = hashlib.sha256()
+    size = 0
+
+    while chunk := file.read(ATTACHMENT_CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+
+    attachment = get_attachment(connection, digest.hexdigest())
+
+    if attachment:
+        return attachment
+
+    file.seek(start)
+
+    # Another connection may have stored the same contents since the lookup
+    cursor.execute("""
+        INSERT OR IGNORE INTO attachments (hash, media_type, size, data)
+        VALUES (?, ?, ?, zeroblob(?))
+    """, (digest.hexdigest(), media_type, size, size))
+
+    if cursor.rowcount != 1:
+        connection.commit()
+        return get_attachment(connection, digest.hexdigest())
+
+    attachment_id = cursor.lastrowid
+
+    with connection.blobopen("attachments", "data", attachment_id) as blob:
+        while chunk := file.read(ATTACHMENT_CHUNK_SIZE):
+            blob.write(chunk)
+
+    connection.commit()
+
+    return get_attachment(connection, digest.hexdigest())
+
+
+def get_attachment(connection: sqlite3.Connection, hash: str) -> Attachment | None:
+    """Return the metadata of an attachment, without its contents."""
+    cursor = connection.cursor()
+
+    row = cursor.execute("""
+        SELECT id, hash, media_type, size, created_at FROM attachments
+        WHERE hash = ?
+    """, (hash,)).fetchone()
+
+    return dict_to_struct(dict(row), Attachment) if row else None
+
+
+def read_attachment(connection: sqlite3.Connection, 
+                    attachment: Attachment, 
+                    start: int = 0, 
+                    end: int = None
+                    ) -> Iterator[bytes]:
+    """Yield the bytes of an attachment from start up to, but not including, end in chunks."""
+    end = attachment.size if end is None else min(end, attachment.size)
+
+    with connection.blobopen("attachments", "data", attachment.id, readonly= True) as blob:
+        blob.seek(start)
+
+        remaining = end - start
+
+        while remaining > 0:
+            chunk = blob.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+
+            yield chunk
+
 # endregion
 
 # region Collections
@@ -269,37 +1173,172 @@ def get_collections(connection: sqlite3.Connection) -> List[Collection]:
 
 # endregion
 
-def generate_markdown(connection: sqlite3.Connection, collection_id: int):
+def _render_markdown(connection: sqlite3.Connection, collection_id: int) -> Iterator[str]:
     paragraphs = get_paragraphs(connection, collection_id= collection_id)
 
-    tags = list(t for p in paragraphs for t in p.tags)
+    tag_paragraphs = {}
+
+    for paragraph in paragraphs:
+        for tag in paragraph.tags:
+            tag_paragraphs.setdefault(tag.id, []).append(paragraph)
+
+    backlinks = get_paragraph_backlinks(connection, collection_id= collection_id)
+
+    paragraphs_by_id = {p.id: p for p in paragraphs}
+    titles = {p.title for p in paragraphs}
+
+    def resolve_link(match: re.Match) -> str:
+        title = match.group(1).strip()
+
+        return get_markdown_hyperlink(title) if title in titles else title
+
+    # Only paragraphs that link somewhere have anything to substitute
+    sources = {i for ids in backlinks.values() for i in ids}
+
+    contents = {
+        p.id: PARAGRAPH_LINK_PATTERN.sub(resolve_link, p.content) if p.id in sources else p.content
+        for p in paragraphs
+    }
+
+    referenced_by = {
+        p.id: [paragraphs_by_id[i] for i in backlinks.get(p.title, []) if i != p.id]
+        for p in paragraphs
+    }
+
+    topics = [
+        {
+            'tag': tag, 
+            'level': min(depth + 2, 6), 
+            'paragraphs': tag_paragraphs.get(tag.id, [])
+        }
+        for tag, depth in get_tag_tree(connection, collection_id= collection_id)
+    ]
 
     # Topics Index
     markdown_template = (
         "# 1. Topics Index\n\n"
-        "{% for tag in tags %}\n"
-            "## {{ tag.description }}\n"
-            "{% for paragraph in paragraphs if tag in paragraph.tags %}\n"
+        "{% for topic in topics %}\n"
+            "{{ '#' * topic.level }} {{ topic.tag.description }}\n"
+            "{% for paragraph in topic.paragraphs %}\n"
             "- {{ paragraph.md_link }}\n"
             "{% endfor %}\n"
         "{% endfor %}\n\n"
         "# 2. Excerpts\n\n"
         "{% for paragraph in paragraphs %}\n"
             "## {{ paragraph.title }}\n"
-            "{{ paragraph.content }}\n\n"
+            "{{ contents[paragraph.id] }}\n\n"
             "**Tags**: {% for tag in paragraph.tags %}{{ tag.md_link }}{% if not loop.last %}, {% endif %}{% endfor %}\n"
+            "{% if referenced_by[paragraph.id] %}\n"
+            "**Referenced by**: {% for source in referenced_by[paragraph.id] %}{{ source.md_link }}{% if not loop.last %}, {% endif %}{% endfor %}\n"
+            "{% endif %}\n"
         "{% endfor %}\n"
         )
 
     template = Template(markdown_template)
     
-    markdown = template.render(paragraphs=paragraphs, tags=tags)
+    return template.generate(
+        paragraphs=paragraphs, topics=topics, contents=contents, referenced_by=referenced_by)
+
+
+def write_markdown(connection: sqlite3.Connection, 
+                   collection_id: int, 
+                   output: TextIO, 
+                   inline_attachments: bool = False, 
+                   attachment_url: str = "attachments/{hash}{extension}", 
+                   attachment_dir: str = None
+                   ):
+    """
+    Write the Markdown of a collection to a text stream as it is rendered. 
+    Attachment references become links built from attachment_url, or data URIs 
+    when inlined, which are base64 encoded chunk by chunk straight into the output.
+    Linked attachments are also saved into attachment_dir when it is given, so 
+    relative links resolve next to the output.
+    Everything is read from one snapshot, so concurrent writes never show up 
+    half-applied in the output.
+    """
+    with read_snapshot(connection):
+        _write_markdown(connection, collection_id, output, inline_attachments, attachment_url, attachment_dir)
+
+
+def _write_markdown(connection: sqlite3.Connection, 
+                    collection_id: int, 
+                    output: TextIO, 
+                    inline_attachments: bool, 
+                    attachment_url: str, 
+                    attachment_dir: str
+                    ):
+    exported = set()
+
+    for chunk in _render_markdown(connection, collection_id):
+        position = 0
+
+        for match in ATTACHMENT_PATTERN.finditer(chunk):
+            output.write(chunk[position:match.start()])
+            position = match.end()
+
+            attachment = get_attachment(connection, match.group(1))
+
+            if not attachment:
+                output.write(match.group(0))
+                continue
 
-    return markdown
+            if not inline_attachments:
+                extension = mimetypes.guess_extension(attachment.media_type) or ''
+
+                if attachment_dir and attachment.hash not in exported:
+                    _export_attachment(connection, attachment, path.join(attachment_dir, attachment.hash + extension))
+                    exported.add(attachment.hash)
+
+                output.write(attachment_url.format(hash= attachment.hash, extension= extension))
+                continue
+
+            output.write(f"data:{attachment.media_type};base64,")
+
+            for data in read_attachment(connection, attachment):
+                output.write(base64.b64encode(data).decode('ascii'))
+
+        output.write(chunk[position:])
+
+
+def _export_attachment(connection: sqlite3.Connection, attachment: Attachment, file_path: str):
+    # Files are named by content, so an existing one already holds these bytes
+    if path.exists(file_path):
+        return
+
+    makedirs(path.dirname(file_path) or '.', exist_ok= True)
+
+    with open(file_path, 'wb') as f:
+        for data in read_attachment(connection, attachment):
+            f.write(data)
+
+
+def generate_markdown(connection: sqlite3.Connection, collection_id: int):
+    markdown = io.StringIO()
+
+    write_markdown(connection, collection_id, markdown)
+
+    return markdown.getvalue()
 
 
 # region Misc
 
+def parse_duration(text: str) -> timedelta:
+    """Parse durations such as 30d, 12h, 2w or 45m."""
+    match = re.fullmatch(r"\s*(\d+)\s*([mhdw])\s*", text.lower())
+
+    if not match:
+        raise ValueError(f"Invalid duration '{text}', expected a number followed by m, h, d or w")
+
+    amount, unit = int(match.group(1)), match.group(2)
+
+    return {
+        'm': timedelta(minutes= amount),
+        'h': timedelta(hours= amount),
+        'd': timedelta(days= amount),
+        'w': timedelta(weeks= amount),
+    }[unit]
+
+
 def open_content_text_editor(content: str = "", editor: TextEditor = TextEditor.NANO) -> str:
     with tempfile.NamedTemporaryFile(mode='w+', encoding='utf8', delete=False) as t:
 
@@ -45,6 +45,7 @@ class Tag(BaseModel):
     id: int
     name: str
     description: Optional[str] = None
+    parent_id: Optional[int] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
     deleted_at: Optional[datetime] = None
@@ -54,6 +55,18 @@ class Tag(BaseModel):
         return get_markdown_hyperlink(self.description)
 
 
+class Attachment(BaseModel):
+    id: int
+    hash: str
+    media_type: str
+    size: int
+    created_at: Optional[datetime] = None
+
+    @property
+    def reference(self):
+        return f"attachment:{self.hash}"
+
+
 class Paragraph(BaseModel):
     id: int
     title: str
@@ -66,4 +79,24 @@ class Paragraph(BaseModel):
 
     @property
     def md_link(self):
-        return get_markdown_hyperlink(self.title)
\ No newline at end of file
+        return get_markdown_hyperlink(self.title)
+
+
+class Excerpt(BaseModel):
+    """API representation of a paragraph, with its tags as ids."""
+    id: Optional[int] = None
+    title: str
+    content: str
+    collection_id: int
+    tags: List[int] = Field(default_factory= list)
+
+
+class ParagraphSummary(BaseModel):
+    id: int
+    title: str
+    collection_id: int
+    tag_count: int = 0
+
+    @property
+    def md_link(self):
+        return get_markdown_hyperlink(self.title)
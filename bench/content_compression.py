@@ -0,0 +1,108 @@
+"""
+Benchmark compressed paragraph content against plain text.
+
+Fills one database per codec with the same generated paragraphs, then reports 
+the database size and the read throughput of get_paragraphs, first on a new 
+connection and then again on the same one. The operating system's file cache is 
+not dropped, so on a machine with enough memory both reads come from memory.
+
+    python bench/content_compression.py --paragraphs 3000 --threshold 256
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import app.func as func
+from app.func import initialize_database, add_collection, add_paragraph, get_paragraphs
+
+
+def connect(db_path: str):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    return conn
+
+
+def read_all(db_path: str):
+    # A new connection starts with an empty SQLite page cache
+    conn = connect(db_path)
+
+    start = time.perf_counter()
+    total = sum(len(p.content) for p in get_paragraphs(conn))
+    first_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_paragraphs(conn)
+    second_time = time.perf_counter() - start
+
+    conn.close()
+
+    return total, first_time, second_time
+
+
+def main():
+    parser = ArgumentParser()
+
+    parser.add_argument("--paragraphs", type=int, default=3000, help="Number of paragraphs")
+    parser.add_argument("--min-words", type=int, default=200)
+    parser.add_argument("--max-words", type=int, default=2000)
+    parser.add_argument("--threshold", type=int, default=256, help="Compression threshold in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    with open(path.join(path.dirname(path.dirname(path.abspath(__file__))), "README.md"), encoding= "utf8") as f:
+        words = f.read().split()
+
+    contents = [
+        " ".join(random.choices(words, k= random.randint(args.min_words, args.max_words)))
+        for _ in range(args.paragraphs)
+    ]
+
+    codecs = [("plain", 0, "zlib"), ("zlib", args.threshold, "zlib")]
+
+    if func.zstandard:
+        codecs.append(("zstd", args.threshold, "zstd"))
+    else:
+        print("zstandard is not installed, skipping zstd")
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'codec':<6} {'size':>10} {'1st read':>10} {'2nd read':>10} {'MB/s':>10}")
+
+        for name, threshold, codec in codecs:
+            func.CONTENT_COMPRESSION_THRESHOLD = threshold
+            func.CONTENT_COMPRESSION = codec
+
+            db_path = path.join(directory, f"{name}.db")
+
+            conn = connect(db_path)
+            conn.execute("PRAGMA synchronous = OFF")
+
+            initialize_database(conn)
+            add_collection(conn, "bench")
+
+            for i, content in enumerate(contents):
+                add_paragraph(conn, 1, f"Paragraph {i}", content, [], allow_duplicate= True)
+
+            conn.execute("VACUUM")
+            conn.close()
+
+            size = path.getsize(db_path)
+            total, first_time, second_time = read_all(db_path)
+
+            print(
+                f"{name:<6} {size / 2**20:>8.1f}MB {first_time:>9.3f}s {second_time:>9.3f}s "
+                f"{total / 2**20 / first_time:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
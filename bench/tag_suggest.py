@@ -0,0 +1,145 @@
+"""
+Benchmark GET /tags/suggest on a generated set of tags.
+
+Fills a temporary database with random tag names (50k by default), some of them 
+used by paragraphs, then requests suggestions for one to three letter prefixes 
+through the API and reports latency percentiles, with and without fuzzy matching.
+Requests are sent straight to the ASGI app from a single event loop, so the 
+numbers cover routing, validation, the query and serialization as a server 
+would see them, without the per-request thread hop of FastAPI's TestClient.
+
+    python bench/tag_suggest.py --tags 50000 --requests 2000
+"""
+import asyncio
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from os import path
+from urllib.parse import urlencode
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from app.func import get_connection, initialize_database, add_collection, add_tag, add_paragraph
+
+
+def percentile(times, p: float) -> float:
+    return sorted(times)[min(int(len(times) * p), len(times) - 1)] * 1000
+
+
+async def get(app, path: str, params: dict) -> int:
+    """Send a GET request to the ASGI app and return the response status."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(params).encode(),
+        "headers": [(b"host", b"bench")],
+        "server": ("bench", 80),
+        "client": ("bench", 0),
+        "root_path": "",
+    }
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+
+    return status
+
+
+async def measure(app, prefixes, fuzzy: bool) -> list:
+    params = {"fuzzy": str(fuzzy).lower()}
+
+    # Warm up the connection pool and the page cache
+    for prefix in prefixes[:50]:
+        await get(app, "/tags/suggest", {**params, "prefix": prefix})
+
+    times = []
+
+    for prefix in prefixes:
+        start = time.perf_counter()
+        status = await get(app, "/tags/suggest", {**params, "prefix": prefix})
+        times.append(time.perf_counter() - start)
+
+        assert status == 200, status
+
+    return times
+
+
+def main():
+    parser = ArgumentParser()
+
+    parser.add_argument("--tags", type=int, default=50000, help="Number of tags")
+    parser.add_argument("--paragraphs", type=int, default=5000, help="Number of paragraphs using tags")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per mode")
+    parser.add_argument("--target", type=float, default=5.0, help="p99 target in milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # get_connection opens paragraphs.db in the working directory
+        os.chdir(directory)
+
+        conn = get_connection()
+        conn.execute("PRAGMA synchronous = OFF")
+
+        initialize_database(conn)
+        add_collection(conn, "bench")
+
+        names = set()
+
+        while len(names) < args.tags:
+            names.add("".join(random.choices(string.ascii_lowercase, k= random.randint(4, 12))))
+
+        tag_ids = [add_tag(conn, name).id for name in names]
+
+        for i in range(args.paragraphs):
+            add_paragraph(conn, 1, f"Paragraph {i}", f"Content {i}", random.sample(tag_ids, 3))
+
+        conn.close()
+
+        # Imported here so the API uses the database created above
+        from app.api import app
+
+        prefixes = [
+            "".join(random.choices(string.ascii_lowercase, k= random.randint(1, 3)))
+            for _ in range(args.requests)
+        ]
+
+        met = True
+
+        for fuzzy in (False, True):
+            times = asyncio.run(measure(app, prefixes, fuzzy))
+            p99 = percentile(times, 0.99)
+            met = met and p99 < args.target
+
+            print(
+                f"fuzzy={fuzzy!s:<5} p50 {percentile(times, 0.5):.2f}ms "
+                f"p95 {percentile(times, 0.95):.2f}ms p99 {p99:.2f}ms"
+            )
+
+        print(f"p99 target of {args.target}ms {'met' if met else 'NOT met'}")
+
+        sys.exit(0 if met else 1)
+
+
+if __name__ == "__main__":
+    main()
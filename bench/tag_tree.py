@@ -0,0 +1,116 @@
+"""
+Benchmark nested tags on a generated tree.
+
+Builds a tree of tags (10k by default) with paragraphs tagged at random, then 
+times get_tag_tree, generate_markdown and descendant queries with get_paragraphs.
+
+    python bench/tag_tree.py --tags 10000 --paragraphs 5000
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from os import path
+from statistics import median
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from app.func import (
+    initialize_database,
+    add_collection,
+    add_tag,
+    add_paragraph,
+    get_paragraphs,
+    get_tag_tree,
+    generate_markdown,
+)
+
+
+def timed(fn, repeat: int):
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    return result, median(times)
+
+
+def main():
+    parser = ArgumentParser()
+
+    parser.add_argument("--tags", type=int, default=10000, help="Number of tags in the tree")
+    parser.add_argument("--paragraphs", type=int, default=5000, help="Number of paragraphs")
+    parser.add_argument("--max-children", type=int, default=8, help="Maximum children per tag")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per timed operation")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(path.join(directory, "bench.db"))
+        conn.row_factory = sqlite3.Row
+
+        # Measure the queries, not fsync
+        conn.execute("PRAGMA synchronous = OFF")
+
+        initialize_database(conn)
+        add_collection(conn, "bench")
+
+        # Breadth-first tree, each tag gets up to max_children children
+        tag_ids = [add_tag(conn, "Tag 0").id]
+        depths = {tag_ids[0]: 0}
+        queue = [tag_ids[0]]
+
+        start = time.perf_counter()
+
+        while len(tag_ids) < args.tags:
+            parent_id = queue.pop(0)
+
+            for _ in range(random.randint(1, args.max_children)):
+                if len(tag_ids) >= args.tags:
+                    break
+
+                tag = add_tag(conn, f"Tag {len(tag_ids)}", parent_id= parent_id)
+
+                tag_ids.append(tag.id)
+                depths[tag.id] = depths[parent_id] + 1
+                queue.append(tag.id)
+
+        insert_time = time.perf_counter() - start
+
+        for i in range(args.paragraphs):
+            add_paragraph(
+                conn, 1, f"Paragraph {i}", f"Content {i}", random.sample(tag_ids, 2), allow_duplicate= True)
+
+        closure_rows = conn.execute("SELECT COUNT(*) FROM tag_parents").fetchone()[0]
+
+        print(f"{len(tag_ids)} tags, max depth {max(depths.values())}, {closure_rows} closure rows")
+        print(f"insert tags:                 {insert_time:.3f}s ({insert_time / len(tag_ids) * 1e6:.0f}us per tag)")
+
+        tree, elapsed = timed(lambda: get_tag_tree(conn), args.repeat)
+        print(f"get_tag_tree:                {elapsed * 1000:.1f}ms ({len(tree)} tags)")
+
+        tree, elapsed = timed(lambda: get_tag_tree(conn, collection_id= 1), args.repeat)
+        print(f"get_tag_tree(collection):    {elapsed * 1000:.1f}ms ({len(tree)} tags)")
+
+        markdown, elapsed = timed(lambda: generate_markdown(conn, 1), args.repeat)
+        print(f"generate_markdown:           {elapsed * 1000:.1f}ms ({len(markdown)} chars)")
+
+        # A subtree root near the middle of the tree
+        middle = next(t for t in tag_ids if depths[t] == max(depths.values()) // 2)
+
+        for label, tag_id in (("root", tag_ids[0]), (f"depth {depths[middle]}", middle)):
+            paragraphs, elapsed = timed(lambda: get_paragraphs(conn, tag_id= tag_id), args.repeat)
+            print(f"get_paragraphs(tag_id={label}): {elapsed * 1000:.1f}ms ({len(paragraphs)} paragraphs)")
+
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
+import sys
 import typer
+import mimetypes
+from os import path
 
 from prompt_toolkit import prompt
-from prompt_toolkit.completion import WordCompleter
+from prompt_toolkit.completion import Completer, Completion, WordCompleter
 
 from app.func import (
-    generate_markdown, 
+    write_markdown,
     initialize_database, 
     get_connection,
     add_collection as db_add_collection,
@@ -15,13 +18,50 @@ from app.func import (
     get_paragraphs as db_get_paragraphs,
     update_paragraph as db_update_paragraph,
     delete_paragraph as db_delete_paragraph,
+    set_tag_parent as db_set_tag_parent,
+    get_broken_links as db_get_broken_links,
+    get_paragraph_summaries as db_get_paragraph_summaries,
+    paragraph_exists as db_paragraph_exists,
+    suggest_tags as db_suggest_tags,
+    find_duplicate_paragraph as db_find_duplicate_paragraph,
+    add_attachment as db_add_attachment,
+    get_memory_snapshot,
+    compact_database,
+    parse_duration,
     open_content_text_editor,
     TextEditor,
     Paragraph
     )
 
 
-def _modify_paragraph_menu(paragraph: Paragraph, text_editor: TextEditor):
+class TagCompleter(Completer):
+    """Completes tag names with a database query per keystroke instead of preloading every tag."""
+
+    def __init__(self, fuzzy: bool = False, limit: int = 20):
+        self.fuzzy = fuzzy
+        self.limit = limit
+
+    def get_completions(self, document, complete_event):
+        prefix = document.text_before_cursor.strip()
+
+        tags = db_suggest_tags(
+            connection= conn, prefix= prefix, limit= self.limit, fuzzy= self.fuzzy)
+
+        for tag in tags:
+            yield Completion(
+                tag.name, 
+                start_position= -len(document.text_before_cursor), 
+                display_meta= tag.description or ''
+                )
+
+
+def _get_tag(name: str):
+    tags = db_get_tags(connection= conn, names= [name])
+
+    return tags[0] if tags else None
+
+
+def _modify_paragraph_menu(paragraph: Paragraph, text_editor: TextEditor, fuzzy_tags: bool = False):
     typer.echo("Leave the field empty to keep the current value.")
 
     title = prompt("Title: ", default= paragraph.title).strip()
@@ -46,13 +86,9 @@ def _modify_paragraph_menu(paragraph: Paragraph, text_editor: TextEditor):
         typer.echo("Content cannot be empty")
         raise typer.Abort()
 
-    tags = db_get_tags(connection= conn)
-
-    tags_dict = {tag.name: tag for tag in tags}
+    tag_completer = TagCompleter(fuzzy= fuzzy_tags)
 
-    tag_completer = WordCompleter(tags_dict.keys(), ignore_case= True)
-
-    tag_list = []
+    tag_ids = set()
 
     typer.echo("Enter tags from the list. Press Enter without typing anything to finish.")
 
@@ -62,20 +98,13 @@ def _modify_paragraph_menu(paragraph: Paragraph, text_editor: TextEditor):
         if not tag_name:
             break
 
-        if tag_name not in tags_dict:
-            typer.echo("Tag not found")
-            continue
+        tag = _get_tag(tag_name.strip())
 
-        tag_list.append(tag_name.strip())
-
-    tag_ids = set()
-    new_tags = set()
-
-    for tag in tag_list:
-        if tag not in tags_dict:
+        if not tag:
+            typer.echo("Tag not found")
             continue
 
-        tag_ids.add(tags_dict[tag].id)
+        tag_ids.add(tag.id)
 
     db_update_paragraph(
         connection= conn,
@@ -108,32 +137,48 @@ try:
         
 
     @app.command()
-    def add_tag(description: str, name: str|None = None):
-        """Add a new tag."""
-        db_add_tag(connection= conn, name= name, description= description)
+    def create_tag(description: str, name: str|None = None, parent_id: int|None = None):
+        """Add a new tag, optionally nested under a parent tag."""
+        try:
+            db_add_tag(connection= conn, name= name, description= description, parent_id= parent_id)
+        except ValueError as e:
+            typer.echo(str(e))
+            raise typer.Abort()
 
         typer.echo("Tag added successfully")
 
 
+    @app.command()
+    def set_tag_parent(tag_id: int, parent_id: int|None = None):
+        """Nest a tag under another tag. Omit the parent to make it a top-level tag."""
+        try:
+            db_set_tag_parent(connection= conn, tag_id= tag_id, parent_id= parent_id)
+        except ValueError as e:
+            typer.echo(str(e))
+            raise typer.Abort()
+
+        typer.echo("Tag moved successfully")
+
+
     @app.command()
     def list_tags():
         """List all tags."""
         tags = db_get_tags(connection= conn)
 
         for tag in tags:
-            typer.echo(f"{tag.id}. {tag.name} - {tag.description}")
+            parent = f" (parent: {tag.parent_id})" if tag.parent_id else ""
+
+            typer.echo(f"{tag.id}. {tag.name} - {tag.description}{parent}")
 
 
     @app.command()
-    def add_paragraph(text_editor: TextEditor = TextEditor.NANO, collection_id: int = None):
+    def add_paragraph(text_editor: TextEditor = TextEditor.NANO, collection_id: int = None, fuzzy_tags: bool = False):
         """Add a new paragraph."""
         typer.echo("Registering a new document...")
 
         collections = db_get_collections(connection= conn)
         
-        tags = db_get_tags(connection= conn)
-        tags_dict = {t.name: t for t in tags}
-        tag_completer = WordCompleter(tags_dict.keys(), ignore_case= True)
+        tag_completer = TagCompleter(fuzzy= fuzzy_tags)
 
         if not collection_id:
             collections_dict = {c.name: c for c in collections}
@@ -195,21 +240,23 @@ try:
 
             tag_list.append(tag_name.strip())
 
-        tag_ids = set()
-        new_tags = set()
+        # Unknown tags are skipped
+        tag_ids = set(tag.id for tag in db_get_tags(connection= conn, names= tag_list))
 
-        for tag in tag_list:
-            if tag in tags_dict:
-                tag_ids.add(tags_dict[tag].id)
-            else:
-                continue
+        duplicate_id = db_find_duplicate_paragraph(
+            connection= conn, collection_id= collection_id, content= content)
+
+        if duplicate_id:
+            typer.confirm(
+                f"Paragraph {duplicate_id} already has the same content. Add it anyway?", abort= True)
 
         db_add_paragraph(
             connection= conn,
             collection_id= collection_id,
             title= title,
             content= content,
-            tag_ids= tag_ids
+            tag_ids= tag_ids,
+            allow_duplicate= True
         )
 
         typer.echo("Document added successfully")
@@ -223,29 +270,28 @@ try:
     def show_paragraph(id: int = None):
         """Show a paragraph, with an option to modify it."""
         if id is None:
-            paragraphs = db_get_paragraphs(connection= conn)
+            summaries = db_get_paragraph_summaries(connection= conn)
 
-            paragraph_dict = {p.id: p for p in paragraphs}
+            summary_ids = {s.id for s in summaries}
 
-            for paragraph in paragraphs:
-                typer.echo(f"{paragraph.id}. {paragraph.title}")
+            for summary in summaries:
+                typer.echo(f"{summary.id}. {summary.title}")
 
             paragraph_id = typer.prompt("Enter the paragraph ID", type= int)
 
-            if not paragraph_id or paragraph_id not in paragraph_dict:
+            if not paragraph_id or paragraph_id not in summary_ids:
                 typer.echo("Invalid paragraph ID")
                 raise typer.Abort()
             
-            paragraph = paragraph_dict[ paragraph_id ]
+            id = paragraph_id
 
-        else:
-            paragraphs = db_get_paragraphs(connection= conn, paragraph_id= id)
+        paragraphs = db_get_paragraphs(connection= conn, paragraph_id= id)
 
-            if not paragraphs:
-                typer.echo("Paragraph not found")
-                raise typer.Abort()
+        if not paragraphs:
+            typer.echo("Paragraph not found")
+            raise typer.Abort()
 
-            paragraph = paragraphs[0]
+        paragraph = paragraphs[0]
 
         # Clear screen
         typer.echo("\033c")
@@ -286,7 +332,7 @@ try:
 
 
     @app.command()
-    def modify_paragraph(id: int, text_editor: TextEditor = TextEditor.NANO):
+    def modify_paragraph(id: int, text_editor: TextEditor = TextEditor.NANO, fuzzy_tags: bool = False):
         """Modify a paragraph."""
         paragraphs = db_get_paragraphs(connection= conn, paragraph_id= id)
 
@@ -296,21 +342,17 @@ try:
 
         paragraph = paragraphs[0]
 
-        _modify_paragraph_menu(paragraph, text_editor)
+        _modify_paragraph_menu(paragraph, text_editor, fuzzy_tags)
 
 
     @app.command()
     def delete_paragraph(id: int):
         """Delete a paragraph."""
-        paragraphs = db_get_paragraphs(connection= conn, paragraph_id= id)
-
-        if not paragraphs:
+        if not db_paragraph_exists(connection= conn, paragraph_id= id):
             typer.echo("Paragraph not found")
             raise typer.Abort()
 
-        paragraph = paragraphs[0]
-
-        db_delete_paragraph(connection= conn, paragraph_id= paragraph.id)
+        db_delete_paragraph(connection= conn, paragraph_id= id)
 
         typer.echo("Document deleted successfully")
 
@@ -318,35 +360,110 @@ try:
     @app.command()
     def add_tag(paragraph_id: int, tag_description: str, tag_name: str = None):
         """Add a tag to a paragraph."""
-        paragraphs = db_get_paragraphs(connection= conn, paragraph_id= paragraph_id)
-
-        if not paragraphs:
+        if not db_paragraph_exists(connection= conn, paragraph_id= paragraph_id):
             typer.echo("Paragraph not found")
             raise typer.Abort()
 
-        paragraph = paragraphs[0]
-
         db_add_tag(
             connection= conn,
             name= tag_name,
             description= tag_description,
-            paragraph_id= paragraph.id
+            paragraph_id= paragraph_id
             )
 
         typer.echo("Tag added successfully")
 
 
     @app.command()
-    def generate(collection_id: int, output: str = None):
-        """Generate Markdown file."""
-        markdown = generate_markdown(connection= conn, collection_id= collection_id)
-
-        if output:
-            with open(output, 'w', encoding='utf8') as f:
-                f.write(markdown)
-            typer.echo(f"Markdown file saved to {output}")
-        else:
-            typer.echo(markdown)
+    def generate(collection_id: int, 
+                 output: str = None, 
+                 inline_attachments: bool = False, 
+                 attachment_url: str = None, 
+                 in_memory: bool = False
+                 ):
+        """
+        Generate Markdown file. With --in-memory, render from an in-memory copy of the database.
+        Attachments are saved into an attachments folder next to the output, unless they are 
+        inlined or linked with --attachment-url (e.g. http://localhost:8000/attachments/{hash}).
+        """
+        source = get_memory_snapshot(conn) if in_memory else conn
+
+        options = {'inline_attachments': inline_attachments}
+
+        if attachment_url:
+            options['attachment_url'] = attachment_url
+        elif not inline_attachments:
+            options['attachment_dir'] = path.join(path.dirname(output or ''), 'attachments')
+
+        try:
+            if output:
+                with open(output, 'w', encoding='utf8') as f:
+                    write_markdown(
+                        connection= source, 
+                        collection_id= collection_id, 
+                        output= f, 
+                        **options
+                        )
+                typer.echo(f"Markdown file saved to {output}")
+            else:
+                write_markdown(
+                    connection= source, 
+                    collection_id= collection_id, 
+                    output= sys.stdout, 
+                    **options
+                    )
+        finally:
+            if in_memory:
+                source.close()
+
+
+    @app.command()
+    def add_attachment(path: str, media_type: str = None):
+        """Store a file as an attachment and print the reference to use in paragraphs."""
+        if not media_type:
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        with open(path, 'rb') as f:
+            attachment = db_add_attachment(connection= conn, file= f, media_type= media_type)
+
+        typer.echo(f"![{path}]({attachment.reference})")
+
+    @app.command()
+    def check_links(collection_id: int = None):
+        """Report [[Title]] links that do not match any paragraph."""
+        broken_links = db_get_broken_links(connection= conn, collection_id= collection_id)
+
+        for link in broken_links:
+            typer.echo(f"{link['paragraph_id']}. {link['title']} -> [[{link['target_title']}]]")
+
+        if broken_links:
+            typer.echo(f"{len(broken_links)} broken link(s) found")
+            raise typer.Exit(code= 1)
+
+        typer.echo("No broken links found")
+
+
+    @app.command()
+    def compact(older_than: str = "30d", batch_size: int = 1000, vacuum: bool = False):
+        """
+        Permanently remove paragraphs deleted longer ago than --older-than, and unused data. 
+        Use --vacuum once to shrink databases created by older versions, while nothing else is using them.
+        """
+        try:
+            duration = parse_duration(older_than)
+        except ValueError as e:
+            raise typer.BadParameter(str(e), param_hint= "--older-than")
+
+        removed = compact_database(
+            connection= conn, older_than= duration, batch_size= batch_size, vacuum= vacuum)
+
+        bytes_reclaimed = removed.pop('bytes_reclaimed')
+
+        for table, count in removed.items():
+            typer.echo(f"{table}: {count} row(s) removed")
+
+        typer.echo(f"{bytes_reclaimed} bytes reclaimed")
+
 
     @app.command()
     def init():